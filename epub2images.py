@@ -1,15 +1,55 @@
+import os
 import sys
+import shlex
+from functools import cache
 from subprocess import run
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from queue import Queue, Empty
+from threading import Thread, Event, local
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from argparse import ArgumentParser
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image
 import numpy as np
-from math import floor
 
-floyd_steinberg = 1/16 * np.array([[0,0,7],[3,5,1]])
-stucki = 1/42 * np.array([[0,0,0,8,4],[2,4,8,4,2],[1,2,4,2,1]])
-atkinson = 1/8 * np.array([[0,0,0,1,1],[0,1,1,1,0],[0,0,1,0,0]])
+# error diffusion matrices, only built (once) when dithering with them
+# (--diffusion floyd-steinberg uses PIL's own implementation, so this one is only
+# used when calling dither() directly)
+@cache
+def floyd_steinberg() -> np.ndarray:
+    return 1/16 * np.array([[0,0,7],[3,5,1]])
+
+@cache
+def stucki() -> np.ndarray:
+    return 1/42 * np.array([[0,0,0,8,4],[2,4,8,4,2],[1,2,4,2,1]])
+
+@cache
+def atkinson() -> np.ndarray:
+    return 1/8 * np.array([[0,0,0,1,1],[0,1,1,1,0],[0,0,1,0,0]])
+
+diffusion_matrices = {'floyd-steinberg': floyd_steinberg, 'stucki': stucki, 'atkinson': atkinson}
+# flags for writing binary page files with os.open (O_BINARY only exists on Windows)
+_O_WRITE = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+_buffers = local()                          # per-thread scratch arrays, reused across pages
+
+def _scratch(name: str, shape: tuple, dtype: type) -> np.ndarray:
+    '''
+    Returns this thread's scratch array called name, only allocating a new one
+    if it doesn't exist yet or doesn't match shape and dtype.
+
+    :param name: name of the scratch array
+    :param shape: shape of array needed
+    :param dtype: data type of array needed
+    :return:
+        uninitialised array of given shape and dtype
+    '''
+
+    buf = getattr(_buffers, name, None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        setattr(_buffers, name, buf)
+    return buf
 
 def waveshare_opts(fontsize: int=8, margins: int=5) -> str:
     '''
@@ -31,30 +71,64 @@ def waveshare_opts(fontsize: int=8, margins: int=5) -> str:
         f'--pdf-page-margin-left={margins} --pdf-page-margin-right={margins}')
     return opts
 
-def dither(px: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+def _diffuse(px: np.ndarray, matrix: np.ndarray) -> None:
+    '''
+    Error diffusion kernel, JIT-compiled by _diffusion_kernel(); thresholds px
+    in place. Uses scalar reads/writes only so no temporary arrays are allocated
+    per pixel, and releases the GIL so pages can be dithered in parallel.
+
+    :param px: contiguous 2D float array of pixel values in [0, 1]
+    :param matrix: error diffusion matrix (odd number of cols)
+    '''
+
+    h, w = px.shape
+    mh, mw = matrix.shape
+    mid = mw // 2                           # middle index of matrix
+
+    for i in range(h):
+        for j in range(w):
+            old = px[i,j]
+            new = 0.0 if old < 0.5 else 1.0
+            px[i,j] = new
+            err = old - new
+            for di in range(mh):
+                ii = i + di
+                if ii >= h:
+                    break
+                for dj in range(mw):
+                    jj = j + dj - mid
+                    if jj >= 0 and jj < w:
+                        px[ii,jj] += err * matrix[di,dj]
+
+@cache
+def _diffusion_kernel():
+    '''
+    Compiles _diffuse with Numba the first time it's needed, so runs that don't
+    dither with it never import numba.
+
+    :return:
+        compiled version of _diffuse
+    '''
+
+    from numba import njit
+    return njit(cache=True, fastmath=True, boundscheck=False, nogil=True)(_diffuse)
+
+def dither(px: np.ndarray, matrix: np.ndarray, out: np.ndarray=None) -> np.ndarray:
     '''
     Uses an error diffusion algorithm defined by matrix to dither px.
 
     :param px: numpy array of greyscale image pixel values
     :param matrix: error diffusion matrix (odd number of cols)
+    :param out: optional contiguous float32 array the shape of px to dither in
     :return:
-        black-and-white dithered version of px
+        black-and-white dithered version of px (out, if given)
     '''
 
-    px = px / 255
-    mid = int(matrix.shape[1] / 2)  # middle index of matrix
-    
-    for i in range(0,px.shape[0]):
-        for j in range(0,px.shape[1]):
-            old = px[i,j]
-            px[i,j] = round(old)
-            err = old - px[i,j]
-            loj = max(0, j - mid)    # low index of matrices
-            hij = min(px.shape[1], j + mid + 1)
-            hii = min(px.shape[0], i + matrix.shape[0])
-            px[i:hii,loj:hij] += err * matrix[0:hii-i,mid+loj-j:mid+hij-j]
+    px = np.divide(px, 255, out=out, dtype=np.float32)
+    _diffusion_kernel()(px, np.ascontiguousarray(matrix, dtype=np.float32))
+    px *= 255
 
-    return px * 255
+    return px
 
           
 def printProgressBar (iteration: int, total: int, prefix: str='Progress:', suffix: str='Complete',
@@ -80,6 +154,82 @@ def printProgressBar (iteration: int, total: int, prefix: str='Progress:', suffi
     if iteration == total: 
         print()
 
+def rasterize(pdf_path: str, npages: int, output_folder: str, pages: Queue, stop: Event,
+              threads: int=1) -> None:
+    '''
+    Renders the PDF to image files in batches of pages and pushes (index, path)
+    of each page onto the queue as soon as its batch is done, followed by None.
+
+    :param pdf_path: path to .pdf file
+    :param npages: number of pages in the PDF
+    :param output_folder: folder to render the page images into
+    :param pages: queue to push rendered pages onto; bounds how far ahead
+                  rendering can get
+    :param stop: event set by the consumer to make rasterize stop early
+    :param threads: number of pdftoppm processes to use per batch
+    '''
+
+    # each batch is a new pdftoppm run that re-parses the PDF, so keep them large
+    batch = max(32, 4 * threads)
+    try:
+        for first in range(1, npages + 1, batch):
+            last = min(first + batch - 1, npages)
+            paths = convert_from_path(pdf_path, size=(480,800), grayscale=True,
+                                      first_page=first, last_page=last,
+                                      thread_count=threads, output_folder=output_folder,
+                                      paths_only=True)
+            # pdftoppm skips pages it fails to render, which would misnumber the rest
+            if len(paths) != last - first + 1:
+                raise RuntimeError(f'Only {len(paths)} of pages {first}-{last} were rendered!')
+            for i, path in enumerate(paths, start=first - 1):
+                if stop.is_set():
+                    return
+                pages.put((i, path))
+    finally:
+        pages.put(None)                     # tell consumer no more pages are coming
+
+def save_page(i: int, path: str, dirname: str, diffusion: str=None, png: bool=False) -> None:
+    '''
+    Loads a rendered page, converts it to black-and-white for the e-ink display
+    and writes it to dirname. The rendered page file is deleted afterwards.
+
+    :param i: page index, used for the output filename
+    :param path: path to rendered page image
+    :param dirname: output directory
+    :param diffusion: name of error diffusion matrix to dither with, if any
+    :param png: save as PNG instead of binary
+    '''
+
+    with Image.open(path) as img:
+        # rotate for display (transposing is a plain pixel copy, no resampling)
+        img = img.transpose(Image.Transpose.ROTATE_90)
+    # crop only if needed -- sometimes images are 481 x 800 or smth
+    if img.size != (800,480):
+        img = img.crop((0,0,800,480))
+    os.remove(path)
+    # convert image to b/w (w/ dithering) for e-ink, packed 8 px per byte
+    if diffusion == 'floyd-steinberg':      # PIL has its own C implementation
+        data = img.convert('1', dither=1).tobytes()
+    else:
+        px = np.asarray(img)
+        if diffusion:
+            px = dither(px, diffusion_matrices[diffusion](),
+                        out=_scratch('dither', px.shape, np.float32))
+        # same threshold and bit layout (MSB first, 1 = white) as PIL's mode '1'
+        bits = np.greater_equal(px, 128, out=_scratch('bits', px.shape, np.bool_))
+        data = np.packbits(bits, axis=1)
+
+    if png:                                 # write to PNG if desired
+        Image.frombytes('1', (800,480), data).save(dirname + f'{i:06d}.png')
+    else:                                   # write to byte stream, unbuffered
+        view = memoryview(data).cast('B')   # flat bytes, whether data is bytes or array
+        fd = os.open(dirname + f'{i:06d}', _O_WRITE, 0o644)
+        try:
+            while view:                     # os.write may not write everything at once
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
 def main(args: list[str]=sys.argv) -> int:
     '''
     Main script called from command line to convert EPUB to series of images
@@ -96,6 +246,8 @@ def main(args: list[str]=sys.argv) -> int:
     parser.add_argument('-f', '--fontsize', type=int, nargs='?', default='8', help='font size, in px')
     parser.add_argument('-m', '--margins', type=int, nargs='?', default='5', help='margin size, in pt')
     parser.add_argument('-d', '--dither', action='store_true', help='dither images in EPUB (must provide EPUB)')
+    parser.add_argument('--diffusion', type=str, choices=diffusion_matrices, default='floyd-steinberg',
+        help='error diffusion matrix to dither with')
     parser.add_argument('--png', action='store_true', help='save images as PNG instead of binary')
     args = parser.parse_args(args[1:])
     
@@ -114,7 +266,9 @@ def main(args: list[str]=sys.argv) -> int:
         
         # Convert EPUB to PDF using Calibre CLI
         print('Converting EPUB to PDF using Calibre... ')
-        run(f'ebook-convert "{epub_path}" "{pdf_path}" {opts}')
+        if run(['ebook-convert', epub_path, pdf_path, *shlex.split(opts)]).returncode != 0:
+            print('Calibre failed to convert EPUB to PDF!')
+            return 1
         print('Done.')
     elif epub_path.endswith("pdf"):         # if pdf, move on
         print('PDF provided.')
@@ -123,43 +277,67 @@ def main(args: list[str]=sys.argv) -> int:
         print('Invalid filetype provided!')
         return 1
 
-    # Convert PDF to Image objects
-    print('Converting PDF to images... ')
-    images = convert_from_path(pdf_path, size=(480,800), grayscale=True)
-    print('Done.')
-
-    # Save images to output/bookname/*.jpg
+    # Save images to output/bookname/
     dirname = f'./output/{fname_stem}/'
     Path(dirname).mkdir(parents=True, exist_ok=True)
-    l = len(images)
+    l = pdfinfo_from_path(pdf_path)['Pages']
     wid = 100
+    ncpu = os.cpu_count() or 1              # cpu_count() is None if undeterminable
 
-    print(f'Saving images to {dirname}... ')
+    # Render PDF pages to images on a background thread (across multiple pdftoppm
+    # processes) while a pool of workers converts and saves the pages already done
+    print(f'Converting PDF to images and saving to {dirname}... ')
     # Initial call to print 0% progress
     printProgressBar(0, wid, decimals=0, length=50)
     j = 0                                   # don't update bar every iteration
-    for i, img in enumerate(images):
-        # rotate for display, then crop -- sometimes images are 481 x 800 or smth
-        img = img.rotate(90, expand=True).crop((0,0,800,480))
-        # convert image to b/w (w/ dithering) for e-ink
-        # if args.dither:
-        #     data = np.array(img)
-        #     img = Image.fromarray(dither(data, atkinson))
-        im_bw = img.convert('1', dither=1 if args.dither else 0)
-
-        if args.png:                        # write to PNG if desired
-            im_bw.save(dirname + f'{i:06d}.png')
-        else:                               # write to byte stream
-            with open(dirname + f'{i:06d}', 'wb') as file:
-                file.write(im_bw.tobytes())
-        # Update Progress Bar only after an appreciable time has passed
-        if floor(i / l * wid) > j:
-            j = floor(i / l * wid)
-            printProgressBar(j, wid, decimals=0, length=50)
+    n = 0                                   # number of pages saved
+    with TemporaryDirectory() as tmp, ThreadPoolExecutor(max_workers=ncpu) as pool:
+        pages = Queue(maxsize=2 * ncpu)
+        stop = Event()
+        producer = Thread(target=rasterize, args=(pdf_path, l, tmp, pages, stop, max(1, ncpu - 1)),
+                          daemon=True)
+        producer.start()
+
+        try:
+            pending = set()
+            submitting = True
+            while submitting or pending:
+                # keep up to 2*ncpu pages in flight, then wait for some to finish
+                while submitting and len(pending) < 2 * ncpu:
+                    item = pages.get()
+                    if item is None:
+                        submitting = False
+                    else:
+                        pending.add(pool.submit(save_page, *item, dirname,
+                                                args.diffusion if args.dither else None, args.png))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                n += len(done)
+                # Update Progress Bar only after an appreciable time has passed
+                step = n * wid // l
+                if step > j:
+                    j = step
+                    printProgressBar(j, wid, decimals=0, length=50)
+        finally:
+            # if a page failed, stop rendering and let pages in progress finish
+            # before the temporary folder is removed; keep draining the queue so
+            # the producer isn't left blocked on it
+            stop.set()
+            pool.shutdown(cancel_futures=True)
+            while producer.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except Empty:
+                    pass
+
+    if n != l:
+        print(f'Only {n} of {l} pages were converted!')
+        return 1
 
     if not args.png:
         with open(dirname + 'HEAD', 'w') as file:
-            file.write(f'{0:06d} {i:06d}')
+            file.write(f'{0:06d} {l - 1:06d}')
 
     print(f'PDF successfully converted. Output can be found in {dirname}.')
     return 0